@@ -17,14 +17,70 @@ import sys
 import nio
 import asyncio
 import io
+import shelve
+import re
+import itertools
+import functools
+import urllib.parse
+import aiohttp
+from collections.abc import AsyncGenerator
+# Optional, faster event loop
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+# Optional, faster JSON encoding of request bodies
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 HOME = pathlib.Path.home()
 
+# Ledger of posted events (old event ID -> new event ID) for resuming interrupted migrations,
+# one per target server and user
+LEDGER = '.migrate_server_state'
+# Upper bound of rooms migrated concurrently
+MAX_ROOM_WORKERS = 8
+# Number of events prefetched ahead of the sender per room
+LOOKAHEAD = 16
+# Upper bound of concurrent media transfers (download and upload) per room
+MAX_TRANSFERS = 6
+# Events per room_messages page (the maximum Synapse accepts)
+PAGE_LIMIT = 1000
+# Size of the chunks media is streamed in from old to new server
+CHUNK_SIZE = 64 * 1024
+# HTTP connection pool of each server (keep-alive in seconds)
+POOL_LIMIT = 64
+POOL_LIMIT_PER_HOST = 32
+KEEPALIVE_TIMEOUT = 60
+# Event types fetched from the old server, posted to the new server and carrying media
+FETCH_TYPES = (nio.RoomMessageFormatted, nio.RedactedEvent, nio.RoomMessageMedia, nio.RoomEncryptedMedia)
+SEND_TYPES = (nio.RoomMessageText, nio.RoomMessageMedia, nio.RoomEncryptedMedia)
+MEDIA_TYPES = (nio.RoomMessageMedia, nio.RoomEncryptedMedia)
+
+# nio encodes all request bodies (room_send in particular) via Api.to_json,
+# orjson's default output is as compact as nio's separators
+if orjson is not None and hasattr(nio.Api, 'to_json'):
+    nio.Api.to_json = staticmethod(lambda content_dict: orjson.dumps(content_dict).decode())
+
 def sys_exit(msg, exit=True) -> None:
     print(msg, file=sys.stderr)
     logging.error(msg)
     if exit:
         sys.exit(-1)
+        
+# Cancel a task which is no longer needed, retrieving the exception of a finished one
+# (avoids 'Task exception was never retrieved' warnings)
+def discard_task(task: asyncio.Task) -> None:
+    if not task.done():
+        task.cancel()
+    elif not task.cancelled():
+        task.exception()
+
+# Raised when the events of a room cannot be fetched completely
+class PaginationError(Exception):
+    pass
 
 @dataclass(kw_only=True)
 class Server:
@@ -52,39 +108,34 @@ class Config:
     def get_verbose(self) -> bool:
         return self.verbose
     
+    def get_window(self) -> int:
+        return self.window
+    
     def parse_cmdline(self) -> dict[str,str]:
         parser = argparse.ArgumentParser('Process server configurations')
         tokens = ['server', 'user', 'password', 'token']
-        self.old_map = {}
-        enum0 = list(enumerate(tokens))
-        help_list = []
-        # Consume copy only in first loop
-        enum1 = enum0.copy()
-        for old in self.old_list:
-            tup = enum1.pop(0)
-            self.old_map[old] = tup[1]
-            help_list.append('old ' + tup[1])
-            
-        self.new_map = {}
-        for new in self.new_list:
-            tup = enum0.pop(0)
-            self.new_map[new] = tup[1]
-            help_list.append('new ' + tup[1])
+        # Map option letters to Server attributes
+        self.old_map = dict(zip(self.old_list, tokens))
+        self.new_map = dict(zip(self.new_list, tokens))
 
-        for opt in self.old_list+self.new_list:
-            help = help_list.pop(0)
-            parser.add_argument('-' + opt, type=str, help=help)
+        for opt, token in self.old_map.items():
+            parser.add_argument('-' + opt, type=str, help='old ' + token)
+        for opt, token in self.new_map.items():
+            parser.add_argument('-' + opt, type=str, help='new ' + token)
             
         parser.add_argument('-V', '--verbose', action='store_true')
+        parser.add_argument('-W', '--window', type=int,
+                            help='number of events posted concurrently (may reorder events within a window)')
         parser.add_argument('-c', '--config', type=str)
             
         # Construct map from parsed option namespace (skip empty elements)
-        ns_map = dict(filter(lambda item: item[1] is not None, vars(parser.parse_args()).items()))
+        ns_map = {key: val for key, val in vars(parser.parse_args()).items() if val is not None}
         
         if 'config' in ns_map:
             self.creds = ns_map['config']
         
-        self.verbose = ns_map['verbose']
+        self.verbose = ns_map.get('verbose', False)
+        self.window = max(ns_map.get('window', 1), 1)
         
         return ns_map
             
@@ -108,23 +159,54 @@ class Config:
                  
 # HACK:
 # Get media from old server before uploading to new server
-async def download_mxc(server: Matrix_Server, url: str) -> bytearray:
-    response = await server.client.download(mxc=url)
-    if hasattr(response, 'body'):
-        return response
-    else:
-        return b''                 
+# (errors are returned as DownloadError for the caller to check)
+async def download_mxc(server: Matrix_Server, url: str) -> nio.DownloadResponse | nio.DownloadError:
+    return await server.client.download(mxc=url)
+
+# Open media on old server as a stream so that it can be piped into the upload
+# without buffering the entire body (nio's download only returns complete bodies)
+async def stream_mxc(server: Matrix_Server, url: str) -> aiohttp.ClientResponse:
+    mxc = urllib.parse.urlparse(url)
+    _, path = nio.Api.download(mxc.netloc, mxc.path.lstrip('/'))
+    # Like nio's _send, move the access token from the query (newer nio versions add it) into the header,
+    # Synapse rejects requests carrying both
+    path = urllib.parse.urlsplit(path)
+    query = [(key, val) for key, val in urllib.parse.parse_qsl(path.query) if key != 'access_token']
+    path = path._replace(query=urllib.parse.urlencode(query)).geturl()
+    headers = {'Authorization': f'Bearer {server.client.access_token}'}
+    # No total timeout (as for nio's transfers), it would also cover piping the body into the upload
+    return await server.client.client_session.get(server.client.homeserver + path, headers=headers,
+                                                  ssl=server.client.ssl,
+                                                  timeout=aiohttp.ClientTimeout(total=None))
+
+# Yield media on old server in chunks from a stream of its own
+async def iter_mxc(server: Matrix_Server, url: str) -> AsyncGenerator[bytes, None]:
+    async with await stream_mxc(server, url) as resp:
+        resp.raise_for_status()
+        async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+            yield chunk
                     
 class Matrix_Server:
-    device_cnt: int = 1
-    def __init__(self, server:Server, verbose=False, old: Matrix_Server = None) -> None:
+    # Shared among instances so that every server gets a distinct device ID
+    _device_counter = itertools.count(1)
+    def __init__(self, server:Server, verbose=False, old: Matrix_Server = None, window: int = 1,
+                 ledger: shelve.Shelf = None) -> None:
         self.server = server
         self.verb = verbose
         self.old = old
-        self.device = f'migrate_server_{self.device_cnt}'
-        self.device_cnt += 1
-        # For the display names of created rooms
-        self.room_names = []
+        # Number of events posted concurrently, the server only guarantees their order for 1
+        self.window = window
+        self.ledger = ledger
+        self.device = f'migrate_server_{next(Matrix_Server._device_counter)}'
+        # Set up by login
+        self.client = None
+        self.logged_in = False
+        # Rooms by display name, set up at login
+        self.rooms_by_name: dict[str, nio.MatrixRoom] = {}
+        # Serialises room creation among concurrent workers
+        self.room_lock = asyncio.Lock()
+        # Transfers of media (yielding the content to post), keyed by mxc URL on the old server
+        self.url_cache: dict[str, asyncio.Task] = {}
     
     async def login(self) -> nio.AsyncClient:
         self.client = nio.AsyncClient(
@@ -133,6 +215,16 @@ class Matrix_Server:
             config=nio.AsyncClientConfig(store=nio.store.database.SqliteMemoryStore),
         )
         self.client.device_id = self.device
+        # Inject a session with a tuned keep-alive pool, nio would otherwise create a default one on first request.
+        # Unlike nio, neither the trace config feeding TransferMonitor nor the connector wrapper limiting
+        # write buffers (which only makes the monitor's progress more granular) are set up, as no transfer
+        # monitors are used here. No proxy connector either, as the client is created without a proxy.
+        connector = aiohttp.TCPConnector(limit=POOL_LIMIT, limit_per_host=POOL_LIMIT_PER_HOST,
+                                         keepalive_timeout=KEEPALIVE_TIMEOUT)
+        self.client.client_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.client.config.request_timeout),
+        )
         # We prefer passwords over access tokens
         if len(self.server.password) > 0:
             login_resp = await self.client.login(password=self.server.password)
@@ -143,21 +235,31 @@ class Matrix_Server:
             sys_exit(f'Logged into server {self.server.server}', False)
         
         if isinstance(login_resp, (nio.LoginResponse)):
+            self.logged_in = True
             await self.sync()
             self.client.load_store()
             
             self.rooms = self.client.rooms
-            for room in self.rooms:
-                self.room_names.append(self.rooms[room].display_name)
+            self.index_rooms()
         
         else:
             logging.error(f'{str(login_resp)}')
             sys_exit(f'Cannot log into {self.server.server}, aborting')
             
     async def logout(self) -> None:
-        resp = await self.client.logout(False)
-        if isinstance(resp, nio.LogoutError):
-            logging.error(f'Logging out from {self.server.server} failed with {str(resp)}')
+        if self.client is None:
+            return
+        
+        try:
+            # Only log out of servers which were logged into
+            if self.logged_in:
+                resp = await self.client.logout(False)
+                if isinstance(resp, nio.LogoutError):
+                    logging.error(f'Logging out from {self.server.server} failed with {str(resp)}')
+                self.logged_in = False
+        finally:
+            # Release pooled connections
+            await self.client.close()
             
         if self.verb:
             sys_exit(f'Logged out of server {self.server.server}', False)
@@ -167,7 +269,12 @@ class Matrix_Server:
             # Limit fetch of room events as they will be fetched later
             sync_filter={"room": {"timeline": {"limit": 1}}})
         if isinstance(sync_resp, (nio.SyncError)):
-            logging(f'Error syncing: {str(sync_resp)}', False)
+            logging.error(f'Error syncing: {str(sync_resp)}')
+            self.prev_batch = {}
+        else:
+            # Pagination start tokens of all joined rooms, reused when fetching their events
+            self.prev_batch = {room_id: room_info.timeline.prev_batch
+                               for room_id, room_info in sync_resp.rooms.join.items()}
         
     def get_rooms(self) -> list[nio.MatrixRoom]:
         return self.rooms
@@ -183,12 +290,17 @@ class Matrix_Server:
         elif self.verb:
             sys_exit(f'Created room {room_name}', False)
             
-        await self.sync()
-        # Update cached data
-        self.rooms = self.client.rooms
-        self.room_names.append(room_name)
+        # Update cached data from the creation parameters instead of a full state sync per room
+        room = nio.MatrixRoom(resp.room_id, self.client.user_id)
+        room.name = room_name
+        room.topic = old_room.topic
+        room.room_version = old_room.room_version
+        self.rooms[room.room_id] = room
+        self.rooms_by_name.setdefault(room_name, room)
         
-        room = self.get_room(room_name)        
+        return room
+    
+    async def set_room_avatar(self, room: nio.MatrixRoom, old_room: nio.MatrixRoom) -> None:
         avatar_url = old_room.gen_avatar_url
         # Create avatar for new room if possible
         if avatar_url != None and len(avatar_url) > 0:
@@ -197,7 +309,8 @@ class Matrix_Server:
                 body = avatar.body
                 size = len(body)
                 if size > 0:
-                    resp, _ = await self.client.upload(io.BytesIO(avatar.body), avatar.content_type, filesize=size)
+                    # BytesIO shares the buffer of a bytes object until written to, so no copy is made
+                    resp, _ = await self.client.upload(io.BytesIO(body), avatar.content_type, filesize=size)
                     if self.verb:
                         if isinstance(resp, nio.UploadResponse):
                             sys_exit(f'Uploaded room avatar, obtained URL {resp.content_uri}', False)
@@ -212,46 +325,94 @@ class Matrix_Server:
                         if isinstance(resp, nio.RoomPutStateError):
                             sys_exit(f'Setting room state of {room.room_id} resulted in {str(resp)}', False)    
         
+    async def get_or_create_room(self, room_name: str) -> nio.MatrixRoom:
+        # Check and creation have to be atomic, otherwise two workers might create the same room
+        async with self.room_lock:
+            if room_name in self.rooms_by_name:
+                return self.get_room(room_name)
+            
+            room = await self.create_room(room_name)
+            
+        # The avatar transfer doesn't need to hold up other workers
+        await self.set_room_avatar(room, self.old.get_room(room_name))
         return room
         
-    async def fetch_room_events(self, start_token: str, room: nio.MatrixRoom, direction: nio.MessageDirection) -> list[nio.Event]:
-        events = []
-        while True:
-            resp = await self.client.room_messages(room.room_id, start_token, 
-                                                       limit=1000, direction=direction)
-            if isinstance(resp, nio.RoomMessagesError):
-                logging.error(f'Failed to get messages for room {room.display_name} @ start_token {start_token}')
+    # Yield fetched events page by page so that sending can start before the room is exhausted
+    async def fetch_room_events(self, start_token: str, room: nio.MatrixRoom, direction: nio.MessageDirection) -> AsyncGenerator[list[nio.Event], None]:
+        cnt = 0
+        # Bind the arguments which are the same for every page
+        room_messages = functools.partial(self.client.room_messages, room.room_id,
+                                          limit=PAGE_LIMIT, direction=direction)
+        fetch = asyncio.create_task(room_messages(start_token))
+        try:
+            while True:
+                resp = await fetch
+                if isinstance(resp, nio.RoomMessagesError):
+                    # Don't migrate a truncated history
+                    raise PaginationError(f'Failed to get messages for room {room.display_name} @ start_token {start_token}: {str(resp)}')
+                    
+                if len(resp.chunk) == 0:
+                    break
                 
-            if len(resp.chunk) == 0:
-                break
-            
-            events.extend(event for event in resp.chunk if isinstance(event, (nio.RoomMessageFormatted, nio.RedactedEvent, 
-                                                                            nio.RoomMessageMedia, nio.RoomEncryptedMedia)))
-            start_token = resp.end
+                start_token = resp.end
+                # Request next page while the current one is being consumed
+                fetch = asyncio.create_task(room_messages(start_token))
+                page = [event for event in resp.chunk if isinstance(event, FETCH_TYPES)]
+                cnt += len(page)
+                yield page
+        finally:
+            # Drop the request for the next page if the consumer stopped early
+            discard_task(fetch)
             
         if self.verb:
-            sys_exit(f'Fetched {len(events)} from room {room.display_name} in direction {str(direction)}', False)
-            
-        return events
+            sys_exit(f'Fetched {cnt} from room {room.display_name} in direction {str(direction)}', False)
 
-    async def get_room_events(self, room: nio.MatrixRoom) -> list[nio.Event]:
-        sync_resp = await self.client.sync(full_state=True, sync_filter={"room": {"timeline": {"limit": 1}}})
-        start_token = sync_resp.rooms.join[room.room_id].timeline.prev_batch
-        events = await self.fetch_room_events(start_token, room, nio.MessageDirection.back)
-        events.reverse()
-        events += await self.fetch_room_events(start_token, room, nio.MessageDirection.front)
-        if self.verb:
-            sys_exit(f'Fetched {len(events)} in total from room {room.display_name}', False)
+    # Yield room events in chronological order
+    async def get_room_events(self, room: nio.MatrixRoom) -> AsyncGenerator[nio.Event, None]:
+        start_token = self.prev_batch.get(room.room_id)
+        # Fetch forward pages concurrently, they are buffered until the backward direction is done
+        front_pages = asyncio.Queue()
+        
+        async def fetch_front() -> None:
+            try:
+                async for page in self.fetch_room_events(start_token, room, nio.MessageDirection.front):
+                    await front_pages.put(page)
+            finally:
+                await front_pages.put(None)
+                
+        front_task = asyncio.create_task(fetch_front())
+        try:
+            # Backward pages arrive newest first, so these have to be complete before reversing
+            events = []
+            async for page in self.fetch_room_events(start_token, room, nio.MessageDirection.back):
+                events.extend(page)
+                
+            events.reverse()
+            cnt = len(events)
+            for event in events:
+                yield event
+                
+            while (page := await front_pages.get()) is not None:
+                cnt += len(page)
+                for event in page:
+                    yield event
+                    
+            await front_task
+        finally:
+            # Stop fetching forward pages if the consumer stopped early
+            discard_task(front_task)
             
-        return events
+        if self.verb:
+            sys_exit(f'Fetched {cnt} in total from room {room.display_name}', False)
     
+    # Map display names to rooms for constant time lookups (first room wins for duplicate names)
+    def index_rooms(self) -> None:
+        self.rooms_by_name = {}
+        for room in self.rooms.values():
+            self.rooms_by_name.setdefault(room.display_name, room)
+            
     def get_room(self, display_name: str) -> nio.MatrixRoom:
-        if display_name in self.room_names:
-            for room in self.rooms:
-                if self.rooms[room].display_name == display_name:
-                    return self.rooms[room]
-        else:
-            return None
+        return self.rooms_by_name.get(display_name)
         
     def get_room_from_id(self, room_id: str) -> nio.MatrixRoom:
         if room_id in self.rooms:
@@ -259,93 +420,229 @@ class Matrix_Server:
         
         return None
 
-    async def post_event(self, room: nio.MatrixRoom, event: nio.Event) -> None:
-        if isinstance(event, (nio.RoomMessageMedia, nio.RoomEncryptedMedia)):
-            # mime = event.mimetype
-            media_data_resp = await download_mxc(self.old, event.url)
-            if hasattr(media_data_resp, 'body'):
-                body = media_data_resp.body
-                name = media_data_resp.filename
-                mime = media_data_resp.content_type
-                body_size = len(body)
-                resp, _ = await self.client.upload(data_provider=io.BytesIO(body), content_type=mime, 
-                                                filename=name, filesize=body_size)
+    # Copy media of an event from the old to the new server and return the content to post
+    async def copy_media(self, event: nio.Event) -> dict:
+        try:
+            async with await stream_mxc(self.old, event.url) as media_resp:
+                if media_resp.status == 200:
+                    disposition = media_resp.content_disposition
+                    if disposition is not None and disposition.filename is not None:
+                        name = disposition.filename
+                    else:
+                        name = urllib.parse.urlparse(event.url).path.lstrip('/')
+                    mime = media_resp.content_type
+                    body_size = media_resp.content_length
+                    if body_size is None:
+                        # Chunked transfer, the upload requires the size up front
+                        body = await media_resp.read()
+                        body_size = len(body)
+                        data_provider = io.BytesIO(body)
+                    else:
+                        # nio calls the provider again when retrying after a 429 or timeout, by
+                        # then the first stream is (partially) consumed, so the media is streamed anew
+                        def data_provider(got_429: int, got_timeouts: int) -> AsyncGenerator[bytes, None]:
+                            if got_429 or got_timeouts:
+                                return iter_mxc(self.old, event.url)
+                            return media_resp.content.iter_chunked(CHUNK_SIZE)
+                    resp, _ = await self.client.upload(data_provider=data_provider, content_type=mime, 
+                                                    filename=name, filesize=body_size)
                 
-                if isinstance(resp, nio.UploadResponse):
-                    if self.verb:   
-                        sys_exit(f'Uploaded {name}, obtained URL {resp.content_uri}', False)
-                    content = {
-                        'body': name,
-                        'info': {
-                            'size': body_size,
-                            'mimetype': mime,
-                        },
-                        'url': resp.content_uri
-                    }
+                    if isinstance(resp, nio.UploadResponse):
+                        if self.verb:   
+                            sys_exit(f'Uploaded {name}, obtained URL {resp.content_uri}', False)
+                        content = {
+                            'body': name,
+                            'info': {
+                                'size': body_size,
+                                'mimetype': mime,
+                            },
+                            'url': resp.content_uri
+                        }
                      
+                    else:
+                        err_str = str(resp)
+                        sys_exit(f'Error when uploading {name}: {err_str}', False)  
+                        content = {
+                            'body': err_str
+                        }
                 else:
-                    err_str = str(resp)
-                    sys_exit(f'Error when uploading {name}: {err_str}', False)  
                     content = {
-                        'body': err_str
+                        'body': 'Empty body, something went wrong'
                     }
-            else:
-                content = {
-                    'body': 'Empty body, something went wrong'
-                }
-                if self.verb:
-                    sys_exit(f'mxc_download returned empty body from url {event.url}', False)
-
-        else:
+                    if self.verb:
+                        sys_exit(f'Media download returned status {media_resp.status} from url {event.url}', False)
+                
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # nio retries these for its own downloads, don't let one transfer abort the migration
             content = {
-                'body': event.body,
+                'body': 'Empty body, something went wrong'
             }
-        
+            sys_exit(f'Transferring media from url {event.url} failed with {str(e)}', False)
+            
+        return content
+    
+    # Media shared between events (or rooms) is only transferred once, later events await the same transfer
+    async def transfer_media(self, event: nio.Event) -> dict:
+        transfer = self.url_cache.get(event.url)
+        if transfer is None:
+            transfer = asyncio.create_task(self.copy_media(event))
+            transfer.add_done_callback(functools.partial(self.uncache_failed, event.url))
+            self.url_cache[event.url] = transfer
+        elif self.verb:
+            sys_exit(f'Reusing upload of {event.url}', False)
+            
+        # Shielded as other events may await the same transfer, copied as the msgtype is added when posting
+        return dict(await asyncio.shield(transfer))
+    
+    # Drop failed transfers (placeholder content without URL) from the cache so that the next event retries
+    def uncache_failed(self, url: str, transfer: asyncio.Task) -> None:
+        if transfer.cancelled() or transfer.exception() is not None or 'url' not in transfer.result():
+            if self.url_cache.get(url) is transfer:
+                del self.url_cache[url]
+                
+    # Build the content of an event ahead of posting it, media transfers are bounded by sem
+    async def prepare_content(self, event: nio.Event, sem: asyncio.Semaphore) -> dict:
+        if isinstance(event, MEDIA_TYPES):
+            async with sem:
+                return await self.transfer_media(event)
+            
+        return {
+            'body': event.body,
+        }
+
+    async def post_event(self, room: nio.MatrixRoom, event: nio.Event, content: dict) -> None:
         msgtype = event.source['content']['msgtype']
         content['msgtype'] = msgtype
         try:
-            await self.client.room_send(room.room_id, message_type='m.room.message', content=content)
+            resp = await self.client.room_send(room.room_id, message_type='m.room.message', content=content)
         except Exception as e:
             sys_exit(f'Exception {str(e)} occurred during message sending')
             
+        # Placeholders of media which couldn't be transferred are recorded as well, retrying them
+        # in a later run would append the media out of order next to the placeholder
+        # Shelf access doesn't yield to the event loop, so concurrent posts need no locking
+        if self.ledger is not None and isinstance(resp, nio.RoomSendResponse):
+            self.ledger[event.event_id] = resp.event_id
+            
         if self.verb:
             strexc = str(content['body'])[:20] + '...'
             sys_exit(f'Posted {msgtype} with body {strexc} to room {room.display_name}', False)
             
-    async def send_events(self, room: nio.MatrixRoom, events: list[nio.Event]):
-        for event in events:
-            # Filter messages
-            if isinstance(event, (nio.RoomMessageText,nio.RoomMessageMedia, nio.RoomEncryptedMedia)):
-                await self.post_event(room, event)
+    # Post a window of events concurrently
+    async def post_window(self, room: nio.MatrixRoom, window: list[tuple[nio.Event, asyncio.Task]]) -> None:
+        contents = await asyncio.gather(*(content for _, content in window))
+        await asyncio.gather(*(self.post_event(room, event, content)
+                               for (event, _), content in zip(window, contents)))
+        
+    # Post events in order while media of the next LOOKAHEAD events is being transferred
+    async def send_events(self, room: nio.MatrixRoom, events: AsyncGenerator[nio.Event, None]):
+        queue = asyncio.Queue(maxsize=LOOKAHEAD)
+        sem = asyncio.Semaphore(MAX_TRANSFERS)
+        
+        async def produce() -> None:
+            try:
+                async for event in events:
+                    # Filter messages
+                    if isinstance(event, SEND_TYPES):
+                        # Skip events posted by a previous run
+                        if self.ledger is not None and event.event_id in self.ledger:
+                            continue
+                        content = asyncio.create_task(self.prepare_content(event, sem))
+                        try:
+                            await queue.put((event, content))
+                        except BaseException:
+                            # Not queued, so the sender won't discard it
+                            discard_task(content)
+                            raise
+            except Exception:
+                # Let the sender terminate before propagating the error
+                await queue.put(None)
+                raise
+            finally:
+                # Stop fetching events when done or cancelled by the sender
+                await events.aclose()
+            
+            # Sentinel terminating the sender
+            await queue.put(None)
                 
+        producer = asyncio.create_task(produce())
+        cnt = 0
+        window = []
+        try:
+            while (item := await queue.get()) is not None:
+                window.append(item)
+                if len(window) == self.window:
+                    await self.post_window(room, window)
+                    cnt += len(window)
+                    window = []
+                    
+            if len(window) > 0:
+                await self.post_window(room, window)
+                cnt += len(window)
+        except BaseException:
+            # Don't leave the producer blocked on a full queue if sending failed
+            producer.cancel()
+            await asyncio.gather(producer, return_exceptions=True)
+            raise
+        finally:
+            # Drop content still being prepared for events which won't be posted
+            for _, content in window:
+                discard_task(content)
+            while not queue.empty():
+                if (item := queue.get_nowait()) is not None:
+                    discard_task(item[1])
+            
+        await producer
         if self.verb:
-            sys_exit(f'Posted {len(events)} to room {room.display_name}', False)
+            sys_exit(f'Posted {cnt} to room {room.display_name}', False)
             
     def get_room_name(self, room: nio.MatrixRoom) -> str:
         return room.display_name
     
     def get_room_names(self) -> list[str]:
-        return self.room_names
+        return list(self.rooms_by_name)
     
 # Worker class helper for asynchronous execution
 class Worker:
-    def __init__(self, old: Matrix_Server, new: Matrix_Server) -> None:
+    def __init__(self, old: Matrix_Server, new: Matrix_Server, sem: asyncio.Semaphore) -> None:
         self.old = old
         self.new = new
+        self.sem = sem
         
     async def process_events(self, room_obj: nio.MatrixRoom) -> None:
-        room_name = self.old.get_room_name(room_obj)
-        events = await self.old.get_room_events(room_obj)
-        if len(events) > 0:
-            if room_name not in self.new.get_room_names():
-                new_room = await self.new.create_room(room_name)
-            else:
-                new_room = self.new.get_room(room_name)
-            
-            # Copy events from old to new room
-            await self.new.send_events(new_room, events)
+        # Bound the number of rooms in flight to stay clear of server rate limits
+        async with self.sem:
+            room_name = self.old.get_room_name(room_obj)
+            events = self.old.get_room_events(room_obj)
+            try:
+                # Only create rooms on the new server which actually have content
+                first = await anext(events, None)
+                if first is not None:
+                    new_room = await self.new.get_or_create_room(room_name)
+                    # Copy events from old to new room
+                    await self.new.send_events(new_room, self.chain(first, events))
+            except PaginationError as e:
+                # Abort this room only, events posted so far are in order and a rerun resumes from the ledger
+                sys_exit(f'{str(e)}, aborting room {room_name}', False)
+            finally:
+                await events.aclose()
+                
+    @staticmethod
+    async def chain(first: nio.Event, events: AsyncGenerator[nio.Event, None]) -> AsyncGenerator[nio.Event, None]:
+        try:
+            yield first
+            async for event in events:
+                yield event
+        finally:
+            await events.aclose()
         
     
+# Ledger file of a target server and user
+def ledger_path(server: Server) -> pathlib.Path:
+    host = urllib.parse.urlparse(server.server).netloc or server.server
+    target = re.sub(r'[^\w.@-]', '_', f'{server.user}@{host}')
+    return HOME / pathlib.Path(f'{LEDGER}.{target}')
+    
 async def main() -> None:
     LOG_DIR = pathlib.Path(HOME, 'log')
     logging.basicConfig(filename=str(LOG_DIR/pathlib.Path(__file__).stem)+'.log', filemode='a', level=logging.DEBUG, format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
@@ -354,20 +651,35 @@ async def main() -> None:
     verb = config.get_verbose()
     
     old = Matrix_Server(config.old, verbose=verb)
-    await old.login()
-    
-    new = Matrix_Server(config.new, verbose=verb, old=old)
-    await new.login()
-    
-    aws = []
-    for room in old.rooms:
-        room_obj = old.get_room_from_id(room)
-        worker = Worker(old, new)
-        aws.append(worker.process_events(room_obj))
+    new = None
+    # Log out (and close connections) even if logging in or the migration fails
+    try:
+        await old.login()
         
-    await asyncio.gather(*aws)
-    await new.logout()
-    await old.logout()
+        with shelve.open(str(ledger_path(config.new))) as ledger:
+            new = Matrix_Server(config.new, verbose=verb, old=old, window=config.get_window(), ledger=ledger)
+            await new.login()
+            
+            sem = asyncio.Semaphore(MAX_ROOM_WORKERS)
+            tasks = []
+            for room in old.rooms:
+                room_obj = old.get_room_from_id(room)
+                worker = Worker(old, new, sem)
+                tasks.append(asyncio.create_task(worker.process_events(room_obj)))
+                
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                # gather returns on the first failure, stop the remaining rooms before
+                # the ledger is closed and the servers are logged out
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+    finally:
+        await asyncio.gather(*(server.logout() for server in (old, new) if server is not None))
 
 if __name__ == '__main__':
-    asyncio.get_event_loop().run_until_complete(main())
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    asyncio.run(main())